@@ -1,131 +1,431 @@
-import os, glob
+import os, argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 import numpy as np
 import rasterio
-from rasterio.warp import reproject, Resampling
+import rasterio.shutil
+from rasterio.warp import reproject, transform_bounds, Resampling
+from rasterio.windows import Window, from_bounds, bounds as window_bounds, transform as window_transform
 import matplotlib.pyplot as plt
 
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+try:
+    import numexpr as ne
+    ne.set_num_threads(os.cpu_count())
+    HAS_NUMEXPR = True
+except ImportError:
+    HAS_NUMEXPR = False
+
+# === Configuración de GDAL para todo el pipeline ===
+# GDAL_CACHEMAX: caché de bloques en MB; retiene tiles JP2/TIF ya decodificados
+#   entre lecturas por ventana (el valor por defecto puede ser de pocos MB)
+# GDAL_NUM_THREADS: decodificación/compresión (OpenJPEG, deflate) y warper con todos los núcleos
+# GDAL_TIFF_INTERNAL_MASK: máscaras de nodata dentro del TIF, no en .msk aparte
+# GDAL_DISABLE_READDIR_ON_OPEN: no listar el directorio al abrir cada archivo
+# CPL_VSIL_CURL_USE_HEAD: evita un HEAD extra por archivo si las entradas son /vsicurl/
+CFG = dict(
+    GDAL_CACHEMAX=1024,
+    GDAL_NUM_THREADS="ALL_CPUS",
+    GDAL_TIFF_INTERNAL_MASK="YES",
+    GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    CPL_VSIL_CURL_USE_HEAD="NO",
+)
+
 # === Carpetas  ===
 DIR20 = "./DATA2020"
 DIR24 = "./DATA2024"
 OUT_DIR = "./salidas_tif_2024"
-os.makedirs(OUT_DIR, exist_ok=True)
+NDVI20_PATH = os.path.join(OUT_DIR, "NDVI_2020.tif")
+NDVI24_PATH = os.path.join(OUT_DIR, "NDVI_2024.tif")
+DIFF_PATH = os.path.join(OUT_DIR, "NDVI_diff_24_minus_20.tif")
+MASK_PATH = os.path.join(OUT_DIR, "deforest_mask.tif")
+# Bandas JP2 transcodificadas a GeoTIFF (una subcarpeta por año), fuera de las salidas
+CACHE_DIR = "./cache_tif"
 
-def find_band(dirpath, band_tag):
-    patt = os.path.join(dirpath, f"*{band_tag}*.tif*")
-    files = sorted(glob.glob(patt))
-    if not files:
-        raise FileNotFoundError(f"No encontré {band_tag} en {dirpath}")
-    return files[0]
+# === NDVI cuantizado: int16 con escala 1e-4 ===
+NDVI_SCALE = 10_000
+NODATA_I16 = -32768
 
-def read_band(path):
-    with rasterio.open(path) as src:
-        arr = src.read(1).astype("float32")
-        profile = src.profile
-        transform = src.transform
-        crs = src.crs
-        nodata = src.nodata
-    return arr, profile, transform, crs, nodata
-
-def reproject_to_match(src_path, match_profile):
-    with rasterio.open(src_path) as src:
-        dst = np.empty((match_profile["height"], match_profile["width"]), dtype="float32")
-        reproject(
-            source=rasterio.band(src, 1),
-            destination=dst,
-            src_transform=src.transform,
-            src_crs=src.crs,
-            dst_transform=match_profile["transform"],
-            dst_crs=match_profile["crs"],
-            resampling=Resampling.bilinear,
-        )
+# --- umbral de pérdida significativa (ΔNDVI) ---
+THRESH = -0.2
+THRESH_I16 = int(round(THRESH * NDVI_SCALE))
+
+# Tolerancia (unidades del CRS) para considerar iguales dos geotransformadas
+GRID_TOL = 1e-6
+
+def scan_bands(dirpath, band_tags=("B04", "B08")):
+    # Un solo listado del directorio para todas las bandas. Por banda se prefiere
+    # GeoTIFF sobre JP2 y, dentro de cada tipo, el primer nombre alfabético
+    hits = {}
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            ext = os.path.splitext(entry.name)[1].lower()
+            if not entry.is_file() or not (ext.startswith(".tif") or ext == ".jp2"):
+                continue
+            key = (ext == ".jp2", entry.name)
+            for tag in band_tags:
+                if tag in entry.name and (tag not in hits or key < hits[tag][0]):
+                    hits[tag] = (key, entry.path)
+    for tag in band_tags:
+        if tag not in hits:
+            raise FileNotFoundError(f"No encontré {tag} en {dirpath}")
+    return {tag: path for tag, (_, path) in hits.items()}
+
+def as_tif(path, cache_dir):
+    # JP2 -> GeoTIFF con CreateCopy de GDAL: los bloques se copian en C sin pasar
+    # por NumPy, y la lectura por ventanas posterior no re-decodifica el JP2.
+    # La copia guarda ruta/tamaño/mtime del JP2 y sólo se reutiliza si coinciden
+    if not path.lower().endswith(".jp2"):
+        return path
+    os.makedirs(cache_dir, exist_ok=True)
+    out_path = os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0] + ".tif")
+    st = os.stat(path)
+    source = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+    if os.path.exists(out_path):
+        with rasterio.open(out_path) as cached:
+            if cached.tags(ns="jp2_cache").get("source") == source:
+                return out_path
+    rasterio.shutil.copy(path, out_path, driver="GTiff", tiled=True, blockxsize=256, blockysize=256,
+                         compress="deflate", NUM_THREADS="ALL_CPUS")
+    with rasterio.open(out_path, "r+") as dst:
+        dst.update_tags(ns="jp2_cache", source=source)
+    return out_path
+
+def reproject_to_match(src_arr, src_transform, src_crs, dst_shape, dst_transform, dst_crs):
+    # Warp del arreglo de bandas en memoria (sin GeoTIFF intermedio); multihilo en GDAL.
+    # Entrada y salida usan NaN como nodata: los píxeles sin dato no entran al
+    # bilinear y fuera de cobertura queda NaN, que el NDVI marca como NODATA_I16
+    dst = np.empty(dst_shape, dtype="float32")
+    reproject(
+        source=src_arr,
+        destination=dst,
+        src_transform=src_transform,
+        src_crs=src_crs,
+        src_nodata=np.nan,
+        dst_transform=dst_transform,
+        dst_crs=dst_crs,
+        dst_nodata=np.nan,
+        resampling=Resampling.bilinear,
+        num_threads=os.cpu_count(),
+        warp_mem_limit=512,
+    )
     return dst
 
-def compute_ndvi(nir, red):
-    denom = (nir + red)
-    ndvi = np.where(denom == 0, np.nan, (nir - red) / denom)
-    ndvi = np.clip(ndvi, -1, 1)
-    return ndvi
+def read_band(src, win, nodata, out=None):
+    # Banda 1 en float32 con el nodata declarado del archivo pasado a NaN. `nodata`
+    # llega como valor para no consultar el dataset desde otro hilo
+    arr = src.read(1, window=win, out=out, out_dtype="float32")
+    if nodata is not None and not np.isnan(nodata):
+        arr[arr == np.float32(nodata)] = np.nan
+    return arr
+
+def source_window(src, win, ref):
+    # Ventana de `src` que cubre el bloque `win` del grid de `ref` (+ margen para el
+    # bilinear). Al submuestrear, GDAL ensancha el kernel en la razón de resoluciones,
+    # así que el margen crece con ella para que no aparezcan costuras entre bloques
+    ratio = max(abs(ref.transform.a / src.transform.a), abs(ref.transform.e / src.transform.e))
+    pad = 2 + int(np.ceil(ratio))
+    left, bottom, right, top = transform_bounds(ref.crs, src.crs, *window_bounds(win, ref.transform))
+    sw = from_bounds(left, bottom, right, top, transform=src.transform)
+    col0 = max(0, int(np.floor(sw.col_off)) - pad)
+    row0 = max(0, int(np.floor(sw.row_off)) - pad)
+    col1 = min(src.width, int(np.ceil(sw.col_off + sw.width)) + pad)
+    row1 = min(src.height, int(np.ceil(sw.row_off + sw.height)) + pad)
+    if col1 <= col0 or row1 <= row0:
+        return None
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+# Geometría de un grid ya copiada del dataset: se puede usar desde otro hilo sin
+# tocar el handle de GDAL mientras un worker lee de él
+Grid = namedtuple("Grid", ["transform", "crs", "shape"])
+
+def on_grid(src, ref):
+    # Mismo grid con tolerancia: redondeos subpíxel entre cadenas JP2->TIF no
+    # deben disparar un warp completo
+    return (src.shape == ref.shape and src.crs == ref.crs
+            and src.transform.almost_equals(ref.transform, precision=GRID_TOL))
+
+def read_on_grid(src, win, ref):
+    # Bloque `win` del grid de `ref` leído desde `src`, reproyectado si hace falta
+    if on_grid(src, ref):
+        return read_band(src, win, src.nodata)
+    sw = source_window(src, win, ref)
+    if sw is None:
+        return np.full((win.height, win.width), np.nan, dtype="float32")
+    arr = read_band(src, sw, src.nodata)
+    return reproject_to_match(arr, src.window_transform(sw), src.crs, (win.height, win.width),
+                              window_transform(win, ref.transform), ref.crs)
+
+if HAS_NUMBA:
+    # Sin fastmath: las bandas traen NaN de nodata y con reassoc/afn LLVM pliega
+    # el chequeo de finitud aunque se quite nnan
+    @njit(parallel=True, cache=True)
+    def _ndvi_kernel(bands, out):
+        # Una sola pasada por píxel: suma, resta, división, clip y cuantización
+        # a int16 fusionados. bands[0] = B04 (rojo), bands[1] = B08 (NIR)
+        for i in prange(bands.shape[1]):
+            for j in range(bands.shape[2]):
+                red = bands[0, i, j]
+                nir = bands[1, i, j]
+                d = nir + red
+                # NaN/inf en cualquiera de las bandas deja d no finito
+                if d == 0 or not np.isfinite(d):
+                    out[i, j] = NODATA_I16
+                    continue
+                v = (nir - red) / d
+                v = -1.0 if v < -1.0 else (1.0 if v > 1.0 else v)
+                out[i, j] = np.int16(np.rint(v * NDVI_SCALE))
+
+    @njit(parallel=True, cache=True)
+    def _diff_stats_mask(n20, n24, thr, nodata, out_diff, out_mask, write_mask):
+        # Diferencia, máscara y conteos en una sola pasada por píxel, sin máscaras
+        # booleanas intermedias. Devuelve (píxeles con pérdida, píxeles válidos)
+        dc = 0
+        vc = 0
+        for i in prange(n20.shape[0]):
+            for j in range(n20.shape[1]):
+                a = n20[i, j]
+                b = n24[i, j]
+                hit = 0
+                if a != nodata and b != nodata:
+                    d = b - a
+                    out_diff[i, j] = d
+                    vc += 1
+                    if d < thr:
+                        hit = 1
+                        dc += 1
+                else:
+                    out_diff[i, j] = nodata
+                if write_mask:
+                    out_mask[i, j] = hit
+        return dc, vc
+
+    # Compilar una vez con arreglos mínimos para no pagar el JIT en el primer tile
+    _warm = np.ones((2, 1, 1), dtype="float32")
+    _ndvi_kernel(_warm, np.empty((1, 1), dtype="int16"))
+    _warm_i16 = np.zeros((1, 1), dtype="int16")
+    _diff_stats_mask(_warm_i16, _warm_i16, -1, NODATA_I16, np.empty_like(_warm_i16),
+                     np.empty((1, 1), dtype="uint8"), True)
+
+# NDVI en dos pasadas: el cociente se evalúa una sola vez (denominador 0 -> nodata)
+# y luego se clipea a [-1, 1] y escala in-place. Una banda NaN/inf deja el cociente
+# en NaN, que `v != v` pasa a nodata junto con los denominadores 0
+NE_RATIO = "where(nir + red == 0, nodata, (nir - red) / (nir + red))"
+NE_SCALE = "where((v != v) | (v == nodata), nodata, where(v < -1, -scale, where(v > 1, scale, v * scale)))"
+
+def compute_ndvi(bands):
+    # NDVI cuantizado (int16 x10000); denominador 0 y bandas NaN/inf -> NODATA_I16
+    red, nir = bands[0], bands[1]
+    if HAS_NUMBA:
+        ndvi = np.empty(nir.shape, dtype="int16")
+        _ndvi_kernel(bands, ndvi)
+        return ndvi
+    if HAS_NUMEXPR:
+        # Sin numba: numexpr calcula el cociente y luego clip + escala, multihilo y sin temporales
+        ndvi = np.empty_like(nir)
+        ne.evaluate(NE_RATIO, local_dict={"nir": nir, "red": red, "nodata": NODATA_I16},
+                    out=ndvi, casting="unsafe")
+        ne.evaluate(NE_SCALE, local_dict={"v": ndvi, "scale": NDVI_SCALE, "nodata": NODATA_I16},
+                    out=ndvi, casting="unsafe")
+        return np.rint(ndvi, out=ndvi).astype("int16")
+    # Sin numba ni numexpr: un solo buffer float, resta, división y clip in-place
+    ndvi = np.empty_like(nir)
+    np.subtract(nir, red, out=ndvi)
+    den = np.add(nir, red)
+    mask = np.isfinite(den) & (den != 0)
+    np.divide(ndvi, den, out=ndvi, where=mask)
+    del den
+    np.clip(ndvi, -1.0, 1.0, out=ndvi)
+    np.multiply(ndvi, NDVI_SCALE, out=ndvi)
+    np.rint(ndvi, out=ndvi)
+    ndvi[~mask] = NODATA_I16
+    return ndvi.astype("int16")
 
-def save_tif(path, arr, profile):
+_NO_MASK = np.empty((0, 0), dtype="uint8")
+
+def diff_block(ndvi20, ndvi24, thr, with_mask=False):
+    # -> (diff int16, máscara uint8 o None, píxeles con pérdida, píxeles válidos)
+    diff = np.empty(ndvi24.shape, dtype="int16")
+    mask = np.empty(ndvi24.shape, dtype="uint8") if with_mask else None
+    if HAS_NUMBA:
+        dc, vc = _diff_stats_mask(ndvi20, ndvi24, thr, NODATA_I16, diff,
+                                  mask if with_mask else _NO_MASK, with_mask)
+        return diff, mask, dc, vc
+    valid = (ndvi20 != NODATA_I16) & (ndvi24 != NODATA_I16)
+    np.subtract(ndvi24, ndvi20, out=diff)
+    diff[~valid] = NODATA_I16
+    loss = (diff < thr) & valid
+    if with_mask:
+        mask[...] = loss
+    return diff, mask, np.count_nonzero(loss), np.count_nonzero(valid)
+
+@contextmanager
+def open_tif(path, profile, dtype="int16", nodata=NODATA_I16, overview_resampling=Resampling.average):
+    # GeoTIFF optimizado: tiles internos 256x256, deflate y overviews 2/4/8/16
     prof = profile.copy()
-    prof.update(dtype="float32", count=1, nodata=np.nan)
+    prof.update(
+        driver="GTiff", dtype=dtype, count=1, nodata=nodata,
+        tiled=True, blockxsize=256, blockysize=256,
+        compress="deflate", predictor=3 if dtype == "float32" else 2, num_threads="all_cpus",
+    )
     with rasterio.open(path, "w", **prof) as dst:
-        dst.write(arr.astype("float32"), 1)
+        if dtype == "int16":
+            dst.scales = (1.0 / NDVI_SCALE,)
+        yield dst
+        dst.build_overviews([2, 4, 8, 16], overview_resampling)
+        dst.update_tags(ns="rio_overview", resampling=overview_resampling.name)
+
+def write_block(dst, arr, win):
+    # Sin copia cuando el bloque ya tiene el dtype de salida y es C-contiguo
+    # (la salida de los kernels); bool -> uint8 es una vista del mismo buffer
+    dtype = np.dtype(dst.dtypes[0])
+    if arr.dtype == np.bool_ and dtype == np.uint8:
+        arr = arr.view(np.uint8)
+    buf = arr if arr.dtype == dtype and arr.flags.c_contiguous else np.ascontiguousarray(arr, dtype=dtype)
+    dst.write(buf, 1, window=win)
+
+def read_band_stack(red_src, nir_src, win, pool):
+    # B04/B08 del bloque en un solo buffer (2, h, w) con la banda como dimensión
+    # externa: el kernel recorre ambas bandas sobre líneas de caché contiguas.
+    # B04 se lee en `pool` mientras este hilo lee B08 (GDAL libera el GIL); la
+    # geometría de B04 se copia antes para no compartir su handle entre hilos
+    stack = np.empty((2, win.height, win.width), dtype="float32")
+    red_grid = Grid(red_src.transform, red_src.crs, red_src.shape)
+    nir_aligned = on_grid(nir_src, red_grid)
+    red_read = pool.submit(read_band, red_src, win, red_src.nodata, out=stack[0])
+    if nir_aligned:
+        read_band(nir_src, win, nir_src.nodata, out=stack[1])
+    else:
+        stack[1] = read_on_grid(nir_src, win, red_grid)
+    red_read.result()
+    return stack
+
+def ndvi_block(red_src, nir_src, win, ref, pool):
+    # NDVI del bloque `win` del grid de `ref`. Si B04 está en otro grid, la pila
+    # B04/B08 se reproyecta en una sola llamada al warper
+    if on_grid(red_src, ref):
+        return compute_ndvi(read_band_stack(red_src, nir_src, win, pool))
+    sw = source_window(red_src, win, ref)
+    if sw is None:
+        return np.full((win.height, win.width), NODATA_I16, dtype="int16")
+    aligned = reproject_to_match(read_band_stack(red_src, nir_src, sw, pool), red_src.window_transform(sw), red_src.crs,
+                                 (2, win.height, win.width), window_transform(win, ref.transform), ref.crs)
+    return compute_ndvi(aligned)
+
+def ndvi_to_tif(red_path, nir_path, out_path, pool):
+    # NDVI por bloques nativos del GeoTIFF: un bloque por banda en memoria
+    with rasterio.open(red_path) as red_src, rasterio.open(nir_path) as nir_src:
+        profile = red_src.profile
+        with open_tif(out_path, profile) as dst:
+            for _, win in dst.block_windows(1):
+                write_block(dst, ndvi_block(red_src, nir_src, win, red_src, pool), win)
+    return profile
+
+def read_preview(path, max_side=2048):
+    # Lectura decimada (GDAL) para graficar sin cargar el raster completo
+    with rasterio.open(path) as src:
+        step = max(1, -(-max(src.height, src.width) // max_side))
+        arr = src.read(1, out_shape=(src.height // step or 1, src.width // step or 1), masked=True)
+        return (arr.astype("float32") * src.scales[0]).filled(np.nan)
 
-def show(arr, title, vmin=None, vmax=None):
+def show(arr, title, vmin=None, vmax=None, max_side=2048):
+    # Decimar a <= max_side px: visualmente igual y mucho menos trabajo para Agg
+    step = max(1, -(-max(arr.shape) // max_side))
     plt.figure()
-    plt.imshow(arr, vmin=vmin, vmax=vmax)
+    plt.imshow(arr[::step, ::step], vmin=vmin, vmax=vmax)
     plt.title(title)
     plt.axis("off")
     plt.colorbar()
     plt.tight_layout()
     plt.show()
 
-# --- localizar bandas ---
-B04_2020 = find_band(DIR20, "B04")
-B08_2020 = find_band(DIR20, "B08")
-B04_2024 = find_band(DIR24, "B04")
-B08_2024 = find_band(DIR24, "B08")
-
-print("2020:", os.path.basename(B04_2020), "|", os.path.basename(B08_2020))
-print("2024:", os.path.basename(B04_2024), "|", os.path.basename(B08_2024))
-
-# --- leer 2020 ---
-red20, prof20, tfm20, crs20, _ = read_band(B04_2020)
-nir20, _, _, _, _ = read_band(B08_2020)
-
-# Asegurar que B04 y B08 de 2020 estén en el mismo grid
-if red20.shape != nir20.shape:
-    nir20 = reproject_to_match(B08_2020, prof20)
-
-ndvi20 = compute_ndvi(nir20, red20)
-save_tif(os.path.join(OUT_DIR, "NDVI_2020.tif"), ndvi20, prof20)
-
-# --- leer 2024 ---
-red24, prof24, tfm24, crs24, _ = read_band(B04_2024)
-nir24, _, _, _, _ = read_band(B08_2024)
-
-if red24.shape != nir24.shape:
-    nir24 = reproject_to_match(B08_2024, prof24)
-
-ndvi24 = compute_ndvi(nir24, red24)
-save_tif(os.path.join(OUT_DIR, "NDVI_2024.tif"), ndvi24, prof24)
-
-# --- reprojectar NDVI 2020 al grid de 2024  ---
-if ndvi20.shape != ndvi24.shape or (tfm20 != tfm24):
-    tmp_path = os.path.join(OUT_DIR, "NDVI_2020_tmp.tif")
-    save_tif(tmp_path, ndvi20, prof20)
-    ndvi20 = reproject_to_match(tmp_path, prof24)
-
-# --- diferencia (2024 - 2020) ---
-diff = ndvi24 - ndvi20
-save_tif(os.path.join(OUT_DIR, "NDVI_diff_24_minus_20.tif"), diff, prof24)
-
-# --- visualizaciones ---
-show(ndvi20, "NDVI 2020", vmin=-1, vmax=1)
-show(ndvi24, "NDVI 2024", vmin=-1, vmax=1)
-show(diff, "Diferencia NDVI (2024 - 2020)", vmin=-1, vmax=1)
-
-# --- máscara de pérdida significativa ---
-THRESH = -0.2  
-valid = (~np.isnan(ndvi20)) & (~np.isnan(ndvi24))
-deforest_mask = (diff < THRESH) & valid
-save_tif(os.path.join(OUT_DIR, "deforest_mask.tif"), deforest_mask.astype("float32"), prof24)
-show(deforest_mask.astype(int), f"Máscara deforestación (diff < {THRESH})", vmin=0, vmax=1)
-
-# --- hectáreas y porcentaje ---
-px_w = abs(prof24["transform"][0])
-px_h = abs(prof24["transform"][4])
-m2_per_pixel = px_w * px_h
-ha_per_pixel = m2_per_pixel / 10_000.0
-
-defor_pixels = np.count_nonzero(deforest_mask)
-valid_pixels = np.count_nonzero(valid)
-
-defor_ha = defor_pixels * ha_per_pixel
-total_ha = valid_pixels * ha_per_pixel
-defor_pct = (defor_ha / total_ha * 100) if total_ha > 0 else np.nan
-
-print(f"Área analizada (sin NaN): {total_ha:,.2f} ha")
-print(f"Hectáreas con pérdida (umbral {THRESH}): {defor_ha:,.2f} ha")
-print(f"Porcentaje de deforestación: {defor_pct:.2f}%")
+def main(args):
+    os.makedirs(OUT_DIR, exist_ok=True)
+    # Sin --mask no se escribe la máscara: borrar la de una corrida anterior para
+    # que no quede junto a salidas nuevas como si fuera de esta corrida
+    if not args.mask and os.path.exists(MASK_PATH):
+        os.remove(MASK_PATH)
+        print("Eliminada máscara de una corrida anterior:", MASK_PATH)
+
+    # --- localizar bandas ---
+    bands20 = scan_bands(DIR20)
+    bands24 = scan_bands(DIR24)
+    # Transcodificación JP2 -> TIF de las cuatro bandas en paralelo (GDAL libera el GIL)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        jobs = [pool.submit(as_tif, bands[tag], os.path.join(CACHE_DIR, year))
+                for year, bands in (("2020", bands20), ("2024", bands24)) for tag in ("B04", "B08")]
+        B04_2020, B08_2020, B04_2024, B08_2024 = (job.result() for job in jobs)
+
+    print("2020:", os.path.basename(B04_2020), "|", os.path.basename(B08_2020))
+    print("2024:", os.path.basename(B04_2024), "|", os.path.basename(B08_2024))
+
+    # --- NDVI 2024, NDVI 2020 en el grid de 2024, diferencia y máscara en una pasada ---
+    # Si los grids coinciden, NDVI_2020.tif se escribe en esta misma pasada y cada
+    # banda de 2020 se lee una sola vez. Si no, NDVI_2020.tif (grid nativo) sale de
+    # una pasada propia y aquí el NDVI 2020 se calcula sobre bandas reproyectadas
+    defor_pixels = 0
+    valid_pixels = 0
+    # Un worker para leer B04 mientras el hilo principal lee B08
+    with ThreadPoolExecutor(max_workers=1) as pool, \
+            rasterio.open(B04_2024) as red24_src, rasterio.open(B08_2024) as nir24_src, \
+            rasterio.open(B04_2020) as red20_src, rasterio.open(B08_2020) as nir20_src:
+        prof24 = red24_src.profile
+        same_grid = on_grid(red20_src, red24_src)
+        if same_grid:
+            print("2020 y 2024 comparten grid: lectura directa, sin reproyección")
+        else:
+            print("Grid 2020 distinto al de 2024: B04/B08 2020 se reproyectan por bloque")
+            ndvi_to_tif(B04_2020, B08_2020, NDVI20_PATH, pool)
+        with open_tif(NDVI24_PATH, prof24) as ndvi_dst, open_tif(DIFF_PATH, prof24) as diff_dst, \
+                (open_tif(NDVI20_PATH, red20_src.profile) if same_grid else nullcontext()) as ndvi20_dst, \
+                (open_tif(MASK_PATH, prof24, dtype="uint8", nodata=None, overview_resampling=Resampling.mode)
+                 if args.mask else nullcontext()) as mask_dst:
+            # Recorrer los tiles de la salida: cada escritura llena un bloque completo
+            for _, win in ndvi_dst.block_windows(1):
+                ndvi24 = ndvi_block(red24_src, nir24_src, win, red24_src, pool)
+                ndvi20 = ndvi_block(red20_src, nir20_src, win, red24_src, pool)
+                # Diferencia en int16: ya viene escalada x10000 y cabe en [-20000, 20000]
+                diff, mask, dc, vc = diff_block(ndvi20, ndvi24, THRESH_I16, with_mask=mask_dst is not None)
+                write_block(ndvi_dst, ndvi24, win)
+                if ndvi20_dst is not None:
+                    write_block(ndvi20_dst, ndvi20, win)
+                write_block(diff_dst, diff, win)
+                if mask_dst is not None:
+                    write_block(mask_dst, mask, win)
+                defor_pixels += dc
+                valid_pixels += vc
+
+    # --- visualizaciones (decimadas) ---
+    if not args.no_plot:
+        show(read_preview(NDVI20_PATH), "NDVI 2020", vmin=-1, vmax=1)
+        show(read_preview(NDVI24_PATH), "NDVI 2024", vmin=-1, vmax=1)
+        show(read_preview(DIFF_PATH), "Diferencia NDVI (2024 - 2020)", vmin=-1, vmax=1)
+        if args.mask:
+            show(read_preview(MASK_PATH), f"Máscara deforestación (diff < {THRESH})", vmin=0, vmax=1)
+
+    # --- hectáreas y porcentaje ---
+    px_w = abs(prof24["transform"][0])
+    px_h = abs(prof24["transform"][4])
+    m2_per_pixel = px_w * px_h
+    ha_per_pixel = m2_per_pixel / 10_000.0
+
+    defor_ha = defor_pixels * ha_per_pixel
+    total_ha = valid_pixels * ha_per_pixel
+    defor_pct = (defor_ha / total_ha * 100) if total_ha > 0 else np.nan
+
+    print(f"Área analizada (sin nodata): {total_ha:,.2f} ha")
+    print(f"Hectáreas con pérdida (umbral {THRESH}): {defor_ha:,.2f} ha")
+    print(f"Porcentaje de deforestación: {defor_pct:.2f}%")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NDVI 2020/2024 y máscara de deforestación")
+    parser.add_argument("--no-plot", action="store_true", help="no mostrar figuras (corridas batch)")
+    parser.add_argument("--mask", action="store_true", help="escribir además deforest_mask.tif")
+    with rasterio.Env(**CFG):
+        main(parser.parse_args())